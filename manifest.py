@@ -16,23 +16,72 @@
 
 from __future__ import print_function
 import argparse
+import collections
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import errno
 import gzip
 import hashlib
+import json
+import mmap
 import os, os.path
 import plasmoul
 from PyHSPlasma import *
 import shutil
-import tempfile
+import struct
+import sys
+import threading
+import time
+import traceback
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
 
 # Define the argument parser (yay for batteries included!)
 parser = argparse.ArgumentParser(description="CyanWorlds.com Engine Manifest Generator")
+parser.add_argument("--auth-destination", help="Destination for legacy auth server files",
+                    default="/home/dirtsand/server/AuthSrv")
 parser.add_argument("-b", "--blacklist", help="A list of files to blacklist from redistributing")
+parser.add_argument("--cache", help="Persistent build cache used to skip unchanged files on later runs")
+parser.add_argument("--delta", help="Write a JSON list of the FileSrv files added, changed and removed by this build "
+                    "(in watch mode, by the latest pass)")
 parser.add_argument("-d", "--destination", help="Destination for generated FileSrv",
                     default="/home/dirtsand/server/FileSrv")
+parser.add_argument("-j", "--jobs", help="Number of files to process in parallel", type=int, default=1)
+parser.add_argument("--dedup", help="Only compress identical files once and hardlink the duplicates",
+                    action="store_true")
+parser.add_argument("--gzip-level", help="gzip compression level", type=int, choices=range(1, 10),
+                    default=9)
+parser.add_argument("--gzip-threads", help="Threads used to compress each large file in blocks", type=int,
+                    default=1)
+parser.add_argument("--block-gzip-threshold", help="Size (in MiB) above which files are compressed in blocks",
+                    type=int, default=8)
 parser.add_argument("-k", "--droid-key", help="notthedroids key",
                     default="31415926535897932384626433832795")
+parser.add_argument("--previous", help="FileSrv (or just its manifests) to compare against for --delta "
+                    "(defaults to the destination as it was before building)")
+parser.add_argument("-r", "--report", help="Write a JSON report of per-phase timings and throughput to this file")
 parser.add_argument("-s", "--source", help="Reference install to build FileSrv from",
                     default="/home/dirtsand/reference_build")
+parser.add_argument("-w", "--write-if-changed", help="Only replace FileSrv files whose contents actually changed",
+                    action="store_true")
+parser.add_argument("-z", "--zero-copy", help="Place uncompressed files with hardlinks/reflinks where possible "
+                    "(hardlinked FileSrv files change if the source is modified in place!)", action="store_true")
+parser.add_argument("--verify", help="Check the FileSrv in the destination against its manifests instead of building",
+                    action="store_true")
+parser.add_argument("--verify-base", help="When verifying, also decompress (and decrypt) files to check the source hashes",
+                    action="store_true")
+parser.add_argument("--watch", help="Keep running and regenerate affected manifests when the source changes",
+                    action="store_true")
+parser.add_argument("--watch-interval", help="Seconds between polls when inotify_simple is not available",
+                    type=float, default=2.0)
 
 # Manifest options are special
 _manifest = parser.add_argument_group()
@@ -61,67 +110,444 @@ DELETED = 32
 
 # some helpers
 DONT_COMPRESS = {".age", ".csv", ".fni", ".ini", ".ogg", ".sdl"}
+XTEA_ENCRYPT = {".age", ".fni", ".csv"}
+DROID_ENCRYPT = {".pak", ".sdl"}
+AUTH_LISTS = (("Python", ".pak"), ("SDL", ".sdl"))
+BLOCK_GZIP_SIZE = 1024 * 1024
+ENCRYPTED_MAGIC = {b"whatdoyousee", b"BriceIsSmart", b"notthedroids"}
+FICLONE = 0x40049409
 CLIENT_PREFIXES = {"pl", "uru"}
 CLIENT_EXTENSIONS = {".exe"}
+SOURCE_DIRS = (".", "avi", "dat", "Python", "SDL", "sfx")
+
+class _Stats:
+    # Per-phase (and per file type) counters. Fed from all the worker threads, hence the lock.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases = {}
+
+    def add(self, phase, file_type, wall, cpu, bytes_in, bytes_out):
+        counters = {"count": 1, "wall": wall, "cpu": cpu, "bytes_in": bytes_in, "bytes_out": bytes_out}
+        if cpu is None:
+            del counters["cpu"]
+        with self._lock:
+            self._add(phase, file_type, counters)
+
+    def _add(self, phase, file_type, counters):
+        by_type = self.phases.setdefault(phase, {})
+        totals = by_type.setdefault(file_type or "", dict.fromkeys(counters, 0))
+        for key, value in counters.items():
+            totals[key] += value
+
+    def merge(self, phases):
+        # Used for stats shipped back from the worker processes
+        with self._lock:
+            for phase, by_type in phases.items():
+                for file_type, counters in by_type.items():
+                    self._add(phase, file_type, counters)
+
+    def report(self):
+        report = {}
+        for phase, by_type in sorted(self.phases.items()):
+            totals = None
+            for counters in by_type.values():
+                if totals is None:
+                    totals = dict(counters)
+                else:
+                    for key, value in counters.items():
+                        totals[key] += value
+            totals["by_type"] = {k: v for k, v in sorted(by_type.items()) if k}
+            report[phase] = totals
+        return report
+
+
+class _Timer:
+    # Times a phase (wall and CPU time of the current thread) and tallies the bytes it chewed through.
+    # Phases that just hand work to a pool and wait on it would always report ~0 CPU, so they
+    # pass thread_cpu=False and don't report any at all.
+    def __init__(self, phase, file_type=None, thread_cpu=True):
+        self.phase = phase
+        self.file_type = file_type
+        self.thread_cpu = thread_cpu
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        return self
+
+    def __exit__(self, type, value, tb):
+        cpu = time.thread_time() - self._cpu if self.thread_cpu else None
+        _stats.add(self.phase, self.file_type, time.perf_counter() - self._wall, cpu,
+                   self.bytes_in, self.bytes_out)
+
+
+class _SourceIndex:
+    # Every phase used to listdir/stat the same handful of directories over and over, which
+    # hurts on NFS. So, we scandir them once up front and answer everything from memory.
+    def __init__(self, source):
+        self._source = source
+        self._stats = {}
+        self._dirs = {}
+        self._by_ext = {}
+        self._dead_prps = {}
+        self._size_counts = None
+        for i in SOURCE_DIRS:
+            self._scan(i)
+
+    def _scan(self, reldir):
+        # Forget anything we knew about this directory
+        for name in self._dirs.get(reldir, []):
+            del self._stats[name if reldir == "." else os.path.join(reldir, name)]
+        for key in [i for i in self._by_ext if i[0] == reldir]:
+            del self._by_ext[key]
+        if reldir == "dat":
+            self._dead_prps.clear()
+        self._size_counts = None
+
+        names = []
+        try:
+            entries = list(os.scandir(os.path.join(self._source, reldir)))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            relpath = entry.name if reldir == "." else os.path.join(reldir, entry.name)
+            self._stats[relpath] = entry.stat()
+            names.append(entry.name)
+        names.sort()
+        self._dirs[reldir] = names
+
+        for name in names:
+            relpath = name if reldir == "." else os.path.join(reldir, name)
+            ext = os.path.splitext(name)[1].lower()
+            self._by_ext.setdefault((reldir, ext), []).append(relpath)
+
+            # Deleted PRP files generally do not appear in .age files, so we will be unable to deal
+            # with them the normal way. So, we need this hack here to check every single PRP...
+            # We won't worry about deleted oggs. Too much work to even think about predicting that!
+            if reldir == "dat" and ext == ".prp" and self._stats[relpath].st_size == 0:
+                age = name.split("_District_", 1)[0]
+                self._dead_prps.setdefault(age, []).append(relpath)
+
+    def rescan(self, reldirs):
+        # Returns the files that appeared, disappeared or changed in those directories
+        def snapshot():
+            return {k: (v.st_size, v.st_mtime_ns) for k, v in self._stats.items()
+                    if (os.path.dirname(k) or ".") in reldirs}
+        old = snapshot()
+        for i in reldirs:
+            self._scan(i)
+        new = snapshot()
+        return {k for k in old.keys() | new.keys() if old.get(k) != new.get(k)}
+
+    def by_ext(self, reldir, ext):
+        return self._by_ext.get((reldir, ext.lower()), [])
+
+    def dead_prps(self, age):
+        return self._dead_prps.get(age, [])
+
+    def isfile(self, relpath):
+        return self.stat(relpath) is not None
+
+    def listdir(self, reldir):
+        return self._dirs.get(reldir, [])
+
+    def shares_size(self, relpath):
+        # Could this file possibly have a twin somewhere in the reference build?
+        if self._size_counts is None:
+            self._size_counts = collections.Counter(i.st_size for i in self._stats.values())
+        stat = self.stat(relpath)
+        return stat is not None and self._size_counts[stat.st_size] > 1
+
+    def stat(self, relpath):
+        reldir = os.path.dirname(relpath) or "."
+        if reldir in self._dirs:
+            return self._stats.get(relpath)
+
+        # Someone's poking outside of the usual directories. Fine, we'll hit the disk.
+        abspath = os.path.join(self._source, relpath)
+        if os.path.isfile(abspath):
+            return os.stat(abspath)
+        return None
+
 
 class ManifestLine:
-    compress_size = 0
+    # Lots of these hang around for the whole build, so keep them skinny.
+    # dest_size is how big the artifact really is on disk (encryption pads things out). It's only
+    # known for files we processed (or cached) this run, and never goes into the manifest itself.
+    __slots__ = ("file", "dest", "base_md5", "compress_md5", "base_size", "compress_size", "flag", "dest_size")
+
+    def __init__(self):
+        self.compress_size = 0
+        self.dest_size = None
 
     def __str__(self):
         line = "{},{},{},{},{},{},{}".format(self.file.replace('\\', '/'), self.dest, self.base_md5,
                                              self.compress_md5, self.base_size, self.compress_size, self.flag)
         return line
 
+    @classmethod
+    def parse(cls, text):
+        line = cls()
+        (line.file, line.dest, line.base_md5, line.compress_md5, base_size,
+         compress_size, flag) = text.rstrip("\r\n").split(',')
+        line.base_size = int(base_size)
+        line.compress_size = int(compress_size)
+        line.flag = int(flag)
+        return line
+
 
+# every manifest written this run (by name), so we never have to parse them back in
+_generated = {}
 
-# global dict of processed files. prevents us from doing a lot of dupe work!
+# global dict of processed files (as futures). prevents us from doing a lot of dupe work!
 _processed = {}
 
-# hacks, just hacks...
-_deadPRPs = set()
+# artifacts by content (see _claim_twin) for deduplication
+_twins = {}
+_twins_lock = threading.Lock()
+
+# manifests (and auth lists) waiting on their files, see _write_manifest
+_pending = []
+
+# which manifest jobs (see make_manifests) asked for each file -- used by watch mode
+_dependents = {}
+_current_job = None
+
+# worker pool that actually churns through the files (and one for compressing big files in blocks)
+_executor = None
+_block_executor = None
+
+# one walk of the reference build that everything else queries -- see _SourceIndex
+_index = None
+
+# destination paths (normalized) that we're not allowed to redistribute
+_blacklisted = set()
+
+# build instrumentation -- see _Timer
+_stats = _Stats()
+
+# persistent build cache -- maps source files to the manifest lines they produced last time
+# and PRPs to the sound buffers found in them.
+CACHE_VERSION = 3
+_cache = {}
+_sound_cache = {}
+
+def _cache_settings():
+    # Anything that changes the generated artifacts for identical input belongs here.
+    settings = {"droid_key": _args.droid_key, "gzip_level": _args.gzip_level}
+    if _args.gzip_threads > 1:
+        settings["block_gzip"] = [BLOCK_GZIP_SIZE, _args.block_gzip_threshold]
+    if _args.dedup:
+        settings["gzip_names"] = False
+    return settings
+
+def _load_cache(fn):
+    global _cache, _sound_cache
+    if not os.path.isfile(fn):
+        return
+
+    try:
+        with open(fn, "r") as handle:
+            data = json.load(handle)
+    except ValueError:
+        print("    WARNING: Build cache '%s' is corrupt, ignoring it..." % fn)
+        return
+
+    if data.get("version") != CACHE_VERSION:
+        print("    Build cache is from another version, everything will be rebuilt...")
+        return
+
+    # Sound buffer listings only depend on the PRPs themselves, so they survive settings changes.
+    _sound_cache = data["sounds"]
+    if data.get("settings") != _cache_settings():
+        print("    Build cache is stale, everything will be rebuilt...")
+        return
+    _cache = data["files"]
+
+def _save_cache(fn):
+    # We only learn the PRPs' hashes when they're processed, so fill those in now.
+    for relpath, entry in _sound_cache.items():
+        file_entry = _cache.get(relpath)
+        if file_entry is None or entry["md5"] is not None:
+            continue
+        if file_entry["size"] == entry["size"] and file_entry["mtime"] == entry["mtime"]:
+            entry["md5"] = file_entry["base_md5"]
+
+    data = {"version": CACHE_VERSION, "settings": _cache_settings(), "files": _cache,
+            "sounds": _sound_cache}
+    tmp = "{}.tmp".format(fn)
+    with open(tmp, "w") as handle:
+        json.dump(data, handle, sort_keys=True)
+    os.replace(tmp, fn)
+
+def _check_cache(file, abspath, stat, subfolder, flag):
+    entry = _cache.get(file)
+    if entry is None:
+        return None
+    if entry["subfolder"] != subfolder or entry["in_flag"] != flag or entry["size"] != stat.st_size:
+        return None
+    if entry["blacklisted"] != _is_blacklisted(entry["dest"]):
+        return None
+    if entry.get("auth_only", False) != _auth_only(file):
+        return None
+
+    # The destination artifact had better still be there...
+    destpath = os.path.join(_args.destination, entry["dest"])
+    if entry["dest_size"] is not None:
+        if not os.path.isfile(destpath) or os.lstat(destpath).st_size != entry["dest_size"]:
+            return None
+    authpath = None if entry["blacklisted"] else _auth_path(file)
+    if authpath is not None and not os.path.isfile(authpath):
+        return None
 
-def _blacklist(fn):
-    def nuke(fn):
-        if os.path.isfile(fn):
-            os.unlink(fn)
+    # If the mtime changed, someone might have just touched the file. Check the content.
+    if entry["mtime"] != stat.st_mtime_ns:
+        if _do_md5(abspath) != entry["base_md5"]:
+            return None
+        entry["mtime"] = stat.st_mtime_ns
 
+    line = ManifestLine()
+    line.file = file
+    line.dest = entry["dest"]
+    line.base_md5 = entry["base_md5"]
+    line.compress_md5 = entry["compress_md5"]
+    line.base_size = entry["base_size"]
+    line.compress_size = entry["compress_size"]
+    line.flag = entry["flag"]
+    line.dest_size = entry["dest_size"]
+    return line
+
+def _store_cache(file, stat, subfolder, flag, line):
+    # Blacklisted files never make it to the destination, but their lines are still good.
+    destpath = os.path.join(_args.destination, line.dest)
+    blacklisted = _is_blacklisted(line.dest)
+    if not blacklisted and os.path.isfile(destpath):
+        dest_size = os.lstat(destpath).st_size
+    else:
+        dest_size = None
+
+    _cache[file] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "subfolder": subfolder,
+                    "in_flag": flag, "dest": line.dest, "dest_size": dest_size, "blacklisted": blacklisted,
+                    "auth_only": _auth_only(file),
+                    "base_md5": line.base_md5, "compress_md5": line.compress_md5,
+                    "base_size": line.base_size, "compress_size": line.compress_size,
+                    "flag": line.flag}
+
+def _normalize_blacklist_path(path):
+    path = path.replace('\\', '/').lower()
+    if path.endswith(".gz"):
+        path = path[:-3]
+    return path
+
+def _load_blacklist(fn):
     with open(fn, "r") as list:
         for line in list:
+            line = line.strip()
             if not line or line.startswith('#') or line.startswith(';') or line.startswith("//"):
                 # this is a comment, obviously...
                 continue
+            _blacklisted.add(_normalize_blacklist_path(line))
+
+def _is_blacklisted(dest):
+    return _normalize_blacklist_path(dest) in _blacklisted
+
+def _auth_path(file):
+    # Legacy clients pull the encrypted (but not compressed) Python and SDL from the auth server.
+    if not _args.auth_preloader:
+        return None
+    reldir, fn = os.path.split(file.replace('\\', '/'))
+    if (reldir, os.path.splitext(fn)[1].lower()) not in AUTH_LISTS:
+        return None
+    return os.path.join(_args.auth_destination, reldir, fn)
 
-            abspath = os.path.join(_args.destination, line.strip())
-            nuke(abspath)
-            nuke(abspath + ".gz")
+def _auth_only(file):
+    # With just -l, the preloader files are only processed for the auth server. No manifest
+    # references them in the FileSrv, so they shouldn't be left lying around there.
+    return _auth_path(file) is not None and not _args.file_preloader
 
-def _encrypt_file(abspath, enc, key=None):
+def _encrypt_file(abspath, enc, key=None, md5=None):
     if plEncryptedStream.IsFileEncrypted(abspath):
         # if it's already encrypted, I assume you know WTF you're doing...
-        return (abspath, False)
+        return None
 
-    outfile = os.path.join(tempfile.gettempdir(), os.path.split(abspath)[1])
+    # Everything is small enough to encrypt in memory, so don't bother with temp files.
     with open(abspath, "rb") as infile:
         data = infile.read() # largest is Python.pak at ~5mb...
+    if md5 is not None:
+        md5.update(data)
+
+    with _Timer("encrypt", os.path.splitext(abspath)[1].lower()) as timer:
+        buf = hsRAMStream()
         stream = plEncryptedStream()
-        stream.open(outfile, fmCreate, enc)
+        stream.open(buf, fmCreate, enc)
         if key is not None:
             stream.setKey(key)
         stream.write(data)
         stream.close()
-    return (outfile, True)
+        timer.bytes_in = len(data)
+        timer.bytes_out = len(buf.buffer)
+    return buf.buffer
+
+def _queue_file(file, subfolder=None, flag=NONE):
+    # Returns a future for the file's ManifestLine (or None if the file is bogus)
+    if _current_job is not None:
+        _dependents.setdefault(file, set()).add(_current_job)
+
+    future = _processed.get(file)
+    if future is None:
+        future = _executor.submit(_do_file, file, subfolder, flag)
+        _processed[file] = future
+    return future
+
+def _read_manifest(name, path=None):
+    with open(os.path.join(path or _args.destination, name), "r") as mfs:
+        return [ManifestLine.parse(i) for i in mfs if i.strip()]
+
+def _write_manifest(name, futures):
+    # Don't wait on the files here, or the pool drains at the end of every manifest. These all
+    # get written once every job has queued its files (see _write_pending).
+    _pending.append((_finish_manifest, (name, list(futures))))
+
+def _write_pending():
+    # Always write in submission order so the manifests are deterministic.
+    while _pending:
+        call, args = _pending.pop(0)
+        call(*args)
+
+def _finish_manifest(name, futures):
+    lines = [i for i in (j.result() for j in futures) if i is not None]
+    _write_text(os.path.join(_args.destination, name), (str(i) for i in lines))
+    _generated[name] = lines
+
+def _write_text(path, lines):
+    # Goes through _OutputFile like everything else, so -w leaves unchanged manifests alone.
+    with _OutputFile(path) as handle:
+        handle.write("".join(i + "\n" for i in lines).encode("utf-8"))
 
 def _do_file(file, subfolder=None, flag=NONE):
-    global _processed
-    if file in _processed:
-        return str(_processed[file]) + "\n"
-
     # Does this file fucking exist?!?!
     abspath = os.path.join(_args.source, file)
-    if not os.path.isfile(abspath):
+    stat = _index.stat(file)
+    if stat is None:
         print("    WARNING: '%s' does not exist! Skipping..." % file)
         return None
 
+    with _Timer("file", os.path.splitext(file)[1].lower()) as timer:
+        # Maybe we already did this file on a previous run?
+        line = _check_cache(file, abspath, stat, subfolder, flag)
+        if line is not None:
+            timer.phase = "cached"
+        else:
+            line = _process_file(file, abspath, stat, subfolder, flag)
+        timer.bytes_in = line.base_size
+        timer.bytes_out = line.compress_size if line.flag & ZIPPED else line.base_size
+    return line
+
+def _process_file(file, abspath, stat, subfolder, flag):
     # Init final path here -- note, might change later due to compression...
     fn = os.path.split(file)[1]
     if subfolder is not None:
@@ -129,12 +555,17 @@ def _do_file(file, subfolder=None, flag=NONE):
     else:
         destpath = os.path.join(_args.destination, fn)
 
+    # Cyan's stuff still gets a manifest line, it just never lands in the destination.
+    blacklisted = _is_blacklisted(os.path.relpath(destpath, _args.destination))
+    discard = blacklisted or _auth_only(file)
+
     # Get some basic swhizzle for the manifest string.
     line = ManifestLine()
+    in_flag = flag
     if flag & DELETED:
         line.base_size = 0
     else:
-        line.base_size = os.lstat(abspath).st_size
+        line.base_size = stat.st_size
 
     # Zero byte files are fucking deleted! (don't fucking compress it)
     if line.base_size == 0:
@@ -143,16 +574,7 @@ def _do_file(file, subfolder=None, flag=NONE):
         line.compress_md5 = _zeroMD5.hexdigest()
         flag |= DELETED
     else:
-        line.base_md5 = _do_md5(abspath)
-
-        # Do we need to encrypt the file?
         ext = os.path.splitext(file)[1].lower()
-        if ext in {".age", ".fni", ".csv"}:
-            abspath, isTemp = _encrypt_file(abspath, plEncryptedStream.kEncXtea)
-        elif ext in {".pak", ".sdl"}:
-            abspath, isTemp = _encrypt_file(abspath, plEncryptedStream.kEncDroid, _droid_key)
-        else:
-            isTemp = False
 
         # So, if this is an execuatable file, and it doesn't look like a game executable,
         # Then it is PROBABLY a redist update. Let's flag those here.
@@ -164,62 +586,340 @@ def _do_file(file, subfolder=None, flag=NONE):
                 flag |= REDIST_UPDATE
 
         # Ensure output directory exists
-        outdir = os.path.split(destpath)[0]
-        if not os.path.isdir(outdir):
-            os.makedirs(outdir)
+        authpath = None if blacklisted else _auth_path(file)
+        if not discard:
+            outdir = os.path.split(destpath)[0]
+            os.makedirs(outdir, exist_ok=True)
+        if authpath is not None:
+            os.makedirs(os.path.split(authpath)[0], exist_ok=True)
 
         # Okay, let's see if this is something we can compress...
         compressed = ext not in DONT_COMPRESS
         if compressed:
             destpath += ".gz"
-            _do_gzip(abspath, destpath)
             flag |= ZIPPED
 
-            line.compress_md5 = _do_md5(destpath)
-            line.compress_size = os.lstat(destpath).st_size
+        # Identical content only needs to be encrypted and compressed once. We only bother
+        # hashing up front if there's another file of the same size lying around.
+        md5 = hashlib.md5()
+        twin, claimed = None, False
+        if _args.dedup and not discard and _index.shares_size(file):
+            _hash_into(abspath, md5)
+            twin, claimed = _claim_twin((md5.hexdigest(), line.base_size, ext in XTEA_ENCRYPT,
+                                         ext in DROID_ENCRYPT, compressed, authpath is not None))
+
+        if twin is not None and not claimed:
+            artifact = twin.result()
+            _do_place(artifact[0], destpath)
+            if authpath is not None:
+                _do_place(artifact[3], authpath)
         else:
-            shutil.copy(abspath, destpath)
-            line.compress_md5 = hashlib.md5().hexdigest()
-
-        # If we created a temporary file, nuke it.
-        if isTemp:
-            os.unlink(abspath)
+            try:
+                artifact = _make_artifact(abspath, ext, destpath, authpath, md5, compressed, discard,
+                                          hashed=twin is not None)
+            except BaseException as e:
+                if claimed:
+                    twin.set_exception(e)
+                raise
+            if claimed:
+                twin.set_result(artifact)
+        line.compress_md5, line.compress_size = artifact[1:3]
+        line.dest_size = artifact[4]
+        line.base_md5 = md5.hexdigest()
 
     # generate the manifest line
     line.file = file
     line.dest = os.path.relpath(destpath, _args.destination)
     line.flag = flag
-    _processed[file] = line
-    return str(line) + "\n"
+    _store_cache(file, stat, subfolder, in_flag, line)
+    return line
+
+def _claim_twin(key):
+    # Returns the future for the artifact of this content, and whether we're the ones who have to make it.
+    with _twins_lock:
+        future = _twins.get(key)
+        if future is not None:
+            return (future, False)
+        future = Future()
+        _twins[key] = future
+        return (future, True)
+
+def _make_artifact(abspath, ext, destpath, authpath, md5, compressed, discard, hashed=False):
+    # Returns (destpath, compress_md5, compress_size, authpath, dest_size). Unless it was already done, the source gets
+    # hashed into md5 along the way. Do we need to encrypt the file? If so, that happens while it's read in.
+    if ext in XTEA_ENCRYPT:
+        buf = _encrypt_file(abspath, plEncryptedStream.kEncXtea, md5=None if hashed else md5)
+    elif ext in DROID_ENCRYPT:
+        buf = _encrypt_file(abspath, plEncryptedStream.kEncDroid, _droid_key, None if hashed else md5)
+    else:
+        buf = None
+
+    # Otherwise, we hash the source as we go -- only read it once!
+    if buf is None:
+        src, hashers = abspath, (() if hashed else (md5.update,))
+    else:
+        src, hashers = buf, ()
+
+    if compressed:
+        compress_md5, compress_size = _do_gzip(src, destpath, *hashers, discard=discard)
+        dest_size = compress_size
+    else:
+        # If the bytes don't change on the way to the FileSrv, let the kernel deal with them.
+        if _args.zero_copy and buf is None and not discard:
+            if not hashed:
+                _hash_into(abspath, md5)
+            _do_place(abspath, destpath, md5.hexdigest())
+            dest_size = os.lstat(destpath).st_size
+        else:
+            dest_size = _do_copy(src, destpath, *hashers, discard=discard)
+        compress_md5, compress_size = hashlib.md5().hexdigest(), 0
+
+    # The auth server wants exactly what we just encrypted, so hand it over while we've got it.
+    if authpath is not None:
+        if buf is not None:
+            _do_copy(buf, authpath)
+        elif _args.zero_copy:
+            _do_place(abspath, authpath)
+        else:
+            # Don't hand the AuthSrv a hardlink into another tree unless we were told to.
+            _do_copy(abspath, authpath)
+    return (destpath, compress_md5, compress_size, authpath, None if discard else dest_size)
+
+class _OutputFile:
+    # Hashes and counts everything written through it on the way to the real file. When we're
+    # only writing changed files, the data goes to a temp file that replaces the real one if
+    # (and only if) the contents differ. That keeps mtimes stable for rsync and friends.
+    # Discarded output (eg blacklisted files) is hashed and counted, but never hits the disk.
+    def __init__(self, path, discard=False):
+        self.path = path
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self._discard = discard
+
+    def __enter__(self):
+        if self._discard:
+            self._handle = None
+            return self
+        if _args.write_if_changed:
+            self._tmppath = "{}.tmp".format(self.path)
+        else:
+            self._tmppath = self.path
+        # Whatever's there now might be a hardlink (-z, --dedup, or a stale temp file), so never
+        # write through it.
+        if os.path.lexists(self._tmppath):
+            os.unlink(self._tmppath)
+        self._handle = open(self._tmppath, "wb")
+        return self
+
+    def __exit__(self, type, value, tb):
+        if self._handle is None:
+            return
+        self._handle.close()
+        if self._tmppath == self.path:
+            return
+
+        if type is not None or self._is_unchanged():
+            os.unlink(self._tmppath)
+        else:
+            os.replace(self._tmppath, self.path)
+
+    def _is_unchanged(self):
+        if not os.path.isfile(self.path):
+            return False
+        if os.lstat(self.path).st_size != self.size:
+            return False
+        return _do_md5(self.path) == self.md5.hexdigest()
+
+    def flush(self):
+        if self._handle is not None:
+            self._handle.flush()
+
+    def write(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+        if self._handle is not None:
+            self._handle.write(data)
+        return len(data)
+
+def _iter_chunks(fn, HAX=1024 * 1024 * 5):
+    # Already in memory? (eg an encrypted file or a mapped FileSrv file)
+    if isinstance(fn, (bytes, mmap.mmap)):
+        view = memoryview(fn)
+        for i in range(0, len(view), HAX):
+            yield view[i:i+HAX]
+        return
 
-def _do_file_action(fn, call):
-    HAX = 1024 * 1024 * 5
     with open(fn, "rb") as handle:
         while True:
             data = handle.read(HAX)
             if not data:
                 break
+            yield data
+
+def _do_file_action(fn, *calls):
+    size = 0
+    for data in _iter_chunks(fn):
+        for call in calls:
             call(data)
+        size += len(data)
+    return size
+
+def _file_type(outfile):
+    fn, ext = os.path.splitext(outfile)
+    if ext == ".gz":
+        ext = os.path.splitext(fn)[1]
+    return ext.lower()
+
+def _do_copy(infile, outfile, *calls, discard=False):
+    with _Timer("copy", _file_type(outfile)) as timer:
+        with _OutputFile(outfile, discard) as handle:
+            timer.bytes_in = _do_file_action(infile, handle.write, *calls)
+        timer.bytes_out = handle.size
+    return handle.size
+
+def _zero_copy(infile, outfile):
+    # Try the cheap ways of getting the data across first. Returns how we pulled it off.
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            return "reflink"
+        except OSError:
+            pass
+
+    size = os.fstat(infile.fileno()).st_size
+    for method, call in (("copy_file_range", getattr(os, "copy_file_range", None)),
+                         ("sendfile", getattr(os, "sendfile", None))):
+        if call is None:
+            continue
+        try:
+            offset = 0
+            while offset < size:
+                if method == "sendfile":
+                    sent = call(outfile.fileno(), infile.fileno(), offset, size - offset)
+                else:
+                    sent = call(infile.fileno(), outfile.fileno(), size - offset, offset, offset)
+                if not sent:
+                    break
+                offset += sent
+            else:
+                return method
+        except OSError as e:
+            if e.errno not in {errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.EBADF}:
+                raise
+        outfile.seek(0)
+        outfile.truncate()
+
+    shutil.copyfileobj(infile, outfile)
+    return "copy"
+
+def _do_place(infile, outfile, md5=None):
+    # The source and destination are byte-for-byte identical, so the source's hash (if we have it)
+    # is enough to tell if the destination is already up to date.
+    if os.path.isfile(outfile) and os.path.samefile(infile, outfile):
+        return
+    if _args.write_if_changed and os.path.isfile(outfile):
+        if md5 is not None and os.lstat(outfile).st_size == os.lstat(infile).st_size:
+            if _do_md5(outfile) == md5:
+                return
+
+    with _Timer("place", _file_type(outfile)) as timer:
+        # Hardlinks can't overwrite, so always go through a temp file.
+        tmppath = "{}.tmp".format(outfile)
+        if os.path.lexists(tmppath):
+            os.unlink(tmppath)
+        try:
+            os.link(infile, tmppath)
+            method = "hardlink"
+        except OSError:
+            with open(infile, "rb") as inhandle, open(tmppath, "wb") as outhandle:
+                method = _zero_copy(inhandle, outhandle)
+        os.replace(tmppath, outfile)
+        # Renaming over another link to the same file is a no-op, and the temp file sticks around.
+        if os.path.lexists(tmppath):
+            os.unlink(tmppath)
+        timer.phase = "place_{}".format(method)
+        timer.bytes_in = timer.bytes_out = os.lstat(outfile).st_size
+
+def _deflate_block(data, zdict, last):
+    if zdict is not None:
+        compressor = zlib.compressobj(_args.gzip_level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(_args.gzip_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    # A sync flush leaves the stream byte aligned without ending it, so the next block can follow.
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def _do_block_gzip(infile, handle, filename, *calls):
+    # pigz-style: the input is chopped into blocks that are deflated independently (each primed with
+    # the tail of the previous block) and stitched back together into one ordinary gzip member.
+    # This is the same header gzip.GzipFile would write.
+    name = filename.encode("latin-1")
+    if name.endswith(b".gz"):
+        name = name[:-3]
+    xfl = {9: 2, 1: 4}.get(_args.gzip_level, 0)
+    if name:
+        handle.write(struct.pack("<BBBBIBB", 0x1F, 0x8B, 8, 0x08, 0, xfl, 0xFF) + name + b"\0")
+    else:
+        handle.write(struct.pack("<BBBBIBB", 0x1F, 0x8B, 8, 0, 0, xfl, 0xFF))
+
+    crc, size = 0, 0
+    pending = collections.deque()
+    zdict = None
+    chunks = _iter_chunks(infile, BLOCK_GZIP_SIZE)
+    block = next(chunks, None)
+    while block is not None:
+        next_block = next(chunks, None)
+        for call in calls:
+            call(block)
+        crc = zlib.crc32(block, crc)
+        size += len(block)
+        pending.append(_block_executor.submit(_deflate_block, block, zdict, next_block is None))
+        zdict = bytes(block[-32768:])
+        block = next_block
+
+        # Don't let the whole file pile up in memory...
+        while len(pending) > _args.gzip_threads * 2:
+            handle.write(pending.popleft().result())
+    while pending:
+        handle.write(pending.popleft().result())
+
+    handle.write(struct.pack("<II", crc & 0xFFFFFFFF, size & 0xFFFFFFFF))
+    return size
+
+def _do_gzip(infile, outfile, *calls, discard=False):
+    if isinstance(infile, bytes):
+        size = len(infile)
+    else:
+        size = os.path.getsize(infile)
+    use_blocks = _block_executor is not None and size >= _args.block_gzip_threshold * 1024 * 1024
+
+    with _Timer("gzip", _file_type(outfile)) as timer:
+        with _OutputFile(outfile, discard) as handle:
+            # We do this so we don't leak information about the build environment via FileSrv.
+            # Also, no timestamp -- identical input should always produce an identical gzip. When
+            # deduplicating, leave the name out too so twins are identical no matter who got there first.
+            filename = "" if _args.dedup else os.path.split(outfile)[1]
+            if use_blocks:
+                timer.phase = "block_gzip"
+                timer.thread_cpu = False
+                timer.bytes_in = _do_block_gzip(infile, handle, filename, *calls)
+            else:
+                with gzip.GzipFile(filename, "wb", _args.gzip_level, handle, mtime=0) as gz:
+                    timer.bytes_in = _do_file_action(infile, gz.write, *calls)
+        timer.bytes_out = handle.size
+    return (handle.md5.hexdigest(), handle.size)
 
-def _do_gzip(infile, outfile):
-    with open(outfile, "wb") as handle:
-        # We do this so we don't leak information about the build environment via FileSrv
-        filename = os.path.split(outfile)[1]
-        with gzip.GzipFile(filename, "wb", fileobj=handle) as gz:
-            with open(infile, "rb") as inhandle:
-                gz.writelines(inhandle)
+def _hash_into(fn, md5):
+    with _Timer("md5", _file_type(fn)) as timer:
+        timer.bytes_in = _do_file_action(fn, md5.update)
 
 def _do_md5(fn):
     md5 = hashlib.md5()
-    _do_file_action(fn, md5.update)
+    _hash_into(fn, md5)
     return md5.hexdigest()
 
 def _process_dir(items, src, dst, indir=".", outdir=".", ext=None, require_ext=False):
-    for item in os.listdir(os.path.join(src, indir)):
-        abspath_in = os.path.join(src, indir, item)
-        if os.path.isdir(abspath_in):
-            continue
-
+    for item in _index.listdir(indir):
         # Make sure extensions are what we expect
         if ext is not None:
             this_ext = os.path.splitext(item)[1].lower()
@@ -231,104 +931,174 @@ def _process_dir(items, src, dst, indir=".", outdir=".", ext=None, require_ext=F
             relpath = os.path.join(indir, item)
         else:
             relpath = item
-        items[relpath] = _do_file(relpath, outdir)
-
-
-
-def _make_age_manifest(agefile):
+        items[relpath] = _queue_file(relpath, outdir)
+
+
+
+def _init_age_worker(args, index, sound_cache):
+    global _args, _index, _sound_cache
+    _args = args
+    _index = index
+    _sound_cache = sound_cache
+
+def _read_sound_buffers(relpath):
+    # Returns the (file_name, split_channel, stream) of every sound buffer in the page, and a new
+    # sound cache entry if the one we have is missing or out of date.
+    stat = _index.stat(relpath)
+    abspath = os.path.join(_args.source, relpath)
+    entry = _sound_cache.get(relpath)
+    if entry is not None and entry["size"] == stat.st_size:
+        if entry["mtime"] == stat.st_mtime_ns:
+            return (entry["sounds"], None)
+        if entry["md5"] is not None and _do_md5(abspath) == entry["md5"]:
+            entry = dict(entry, mtime=stat.st_mtime_ns)
+            return (entry["sounds"], entry)
+
+    sounds = []
+    with _Timer("prp_parse", ".prp") as timer:
+        with plasmoul.page(abspath) as prp:
+            # Read them in file order, but keep the manifest in keyring order like always.
+            keys = prp.get_keys(plasmoul.plSoundBuffer.class_type)
+            sbufs = {i.uoid: i for i in prp.get_objects(keys)}
+            for i in keys:
+                sbuf = sbufs[i.uoid]
+                sounds.append((sbuf.file_name, sbuf.split_channel, sbuf.stream))
+        timer.bytes_in = stat.st_size
+    entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "md5": None, "sounds": sounds}
+    return (sounds, entry)
+
+def _scan_age(agefile):
+    # Figures out what goes in an age manifest. This is the slow part (reading the age and
+    # parsing all those PRPs), so it runs in a worker process. Returns (file, subfolder, flag)
+    # tuples in manifest order -- the actual files get processed back in the main process --
+    # along with any sound cache updates.
     ageName = os.path.splitext(agefile)[0]
-    mfs_path = os.path.join(_args.destination, "{}.mfs".format(ageName))
 
-    with open(mfs_path, "w") as mfs:
-        for i in {agefile, "{}.fni".format(ageName), "{}.csv".format(ageName)}:
-            abspath = os.path.join(_args.source, "dat", i)
-            if os.path.isfile(abspath):
-                mfs.write(_do_file(os.path.join("dat", i), "GameBase"))
+    files = []
+    for i in (agefile, "{}.fni".format(ageName), "{}.csv".format(ageName)):
+        relpath = os.path.join("dat", i)
+        if _index.isfile(relpath):
+            files.append((relpath, "GameBase", NONE))
 
-        # Read in age file and get the PRPs...
+    # Read in age file and get the PRPs...
+    with _Timer("age_read", ".age"):
         res = plResManager()
         res.setVer(pvMoul)
         info = res.ReadAge(os.path.join(_args.source, "dat", agefile), False)
-        
-        # Grab the pages
-        for i in range(info.getNumCommonPages(pvMoul)):
-            prp = os.path.join("dat", info.getCommonPageFilename(i, pvMoul))
-            line = _do_file(prp, "GameData")
-            if line:
-                mfs.write(line)
-        
-        for i in range(info.getNumPages()):
-            prp = os.path.join("dat", info.getPageFilename(i, pvMoul))
-            line = _do_file(prp, "GameData")
-            if line:
-                mfs.write(line)
-        
-        # Now, we do the fun part and enumerate the sfx
-        for i in range(info.getNumPages()):
-            path = os.path.join(_args.source, "dat", info.getPageFilename(i, pvMoul))
-            if not os.path.exists(path):
-                continue
-            with plasmoul.page(path) as prp:
-                for i in prp.get_keys(plasmoul.plSoundBuffer.class_type):
-                    sbuf = prp.get_object(i)
 
-                    flags = NONE
-                    if sbuf.split_channel:
-                        flags |= OGG_SPLIT_CHANNEL
-                    else:
-                        flags |= OGG_STEREO
-                    if sbuf.stream:
-                        flags |= OGG_STREAM
-                    line = _do_file(os.path.join("sfx", sbuf.file_name), "GameAudio", flags)
-                    if line:
-                        mfs.write(line)
-
-        # Special Case: Deleted PRPs are generally not in age files.
-        prp_prefix = os.path.join("dat", "%s_District_" % ageName)
-        for i in _deadPRPs:
-            if i.startswith(prp_prefix):
-                mfs.write(_do_file(i, "GameData", DELETED))
+    # Grab the pages
+    for i in range(info.getNumCommonPages(pvMoul)):
+        prp = os.path.join("dat", info.getCommonPageFilename(i, pvMoul))
+        files.append((prp, "GameData", NONE))
+
+    for i in range(info.getNumPages()):
+        prp = os.path.join("dat", info.getPageFilename(i, pvMoul))
+        files.append((prp, "GameData", NONE))
+
+    # Now, we do the fun part and enumerate the sfx
+    sound_updates = {}
+    for i in range(info.getNumPages()):
+        relpath = os.path.join("dat", info.getPageFilename(i, pvMoul))
+        if not _index.isfile(relpath):
+            continue
+
+        sounds, entry = _read_sound_buffers(relpath)
+        if entry is not None:
+            sound_updates[relpath] = entry
+        for file_name, split_channel, stream in sounds:
+            flags = NONE
+            if split_channel:
+                flags |= OGG_SPLIT_CHANNEL
+            else:
+                flags |= OGG_STEREO
+            if stream:
+                flags |= OGG_STREAM
+            files.append((os.path.join("sfx", file_name), "GameAudio", flags))
+
+    # Special Case: Deleted PRPs are generally not in age files.
+    for i in _index.dead_prps(ageName):
+        files.append((i, "GameData", DELETED))
+    return (files, sound_updates)
+
+def _scan_age_worker(agefile):
+    # We're in another process, so our stats have to be shipped back along with the results.
+    global _stats
+    _stats = _Stats()
+    files, sound_updates = _scan_age(agefile)
+    return (files, sound_updates, _stats.phases)
+
+def _make_age_manifest(agefile, scan=None):
+    ageName = os.path.splitext(agefile)[0]
+
+    # The age may have already been scanned in the background. Either way, we queue the files
+    # here, in order, so shared PRPs and sfx are processed exactly once -- just like a serial build.
+    if scan is not None:
+        files, sound_updates, phases = scan.result()
+        _stats.merge(phases)
+    else:
+        files, sound_updates = _scan_age(agefile)
+    _sound_cache.update(sound_updates)
+    lines = [_queue_file(*i) for i in files]
+    _write_manifest("{}.mfs".format(ageName), lines)
 
 def _make_auth_lists():
-    raise NotImplementedError("too lazy to support auth lists")
+    # These ride on the preloader files -- the auth copies get written out while those are
+    # processed, so all that's left to do here is stat them for the lists.
+    src = _args.source
+    dst = _args.destination
+
+    lists = []
+    for reldir, ext in AUTH_LISTS:
+        items = {}
+        _process_dir(items, src, dst, reldir, "ClientPreload", {ext}, True)
+        lists.append(("{}_{}.list".format(reldir, ext[1:]), items))
+
+    _pending.append((_finish_auth_lists, (lists,)))
+
+def _finish_auth_lists(lists):
+    os.makedirs(_args.auth_destination, exist_ok=True)
+    for name, items in lists:
+        entries = []
+        for line in (i.result() for i in items.values()):
+            if line is None or line.flag & DELETED or _is_blacklisted(line.dest):
+                continue
+            authpath = _auth_path(line.file)
+            entries.append("{},{}".format(line.file.replace('\\', '/'), os.lstat(authpath).st_size))
+        _write_text(os.path.join(_args.auth_destination, name), entries)
 
 def _make_client_manifest(preloader):
     def generate_manifest(dst, name, items, exe_blacklist=None):
-        abspath = os.path.join(dst, name)
-        with open(abspath, "w") as mfs:
-            for item in items:
-                fn, ext = os.path.splitext(item)
-                fn = fn.lower()
-                ext = ext.lower()
-
-                if ext in CLIENT_EXTENSIONS:
-                    if exe_blacklist is not None and fn.startswith(exe_blacklist):
-                        continue
-                mfs.write(items[item])
+        lines = []
+        for item in items:
+            fn, ext = os.path.splitext(item)
+            fn = fn.lower()
+            ext = ext.lower()
+
+            if ext in CLIENT_EXTENSIONS:
+                if exe_blacklist is not None and fn.startswith(exe_blacklist):
+                    continue
+            lines.append(items[item])
+        _write_manifest(name, lines)
 
     def generate_patcher_manifest(src, dst, name, launcher_exe):
-        abspath = os.path.join(dst, name)
-        with open(abspath, "w") as mfs:
-            for item in os.listdir(src):
-                abspath_in = os.path.join(src, item)
-                if os.path.isdir(abspath_in):
-                    continue
+        lines = []
+        for item in _index.listdir("."):
+            fn, ext = os.path.splitext(item)
+            if ext.lower() in CLIENT_EXTENSIONS:
+                fn = fn.lower()
 
-                fn, ext = os.path.splitext(item)
-                if ext.lower() in CLIENT_EXTENSIONS:
-                    fn = fn.lower()
-
-                    bad_client = False
-                    for i in CLIENT_PREFIXES:
-                        if fn.startswith(i):
-                            bad_client = (fn != launcher_exe)
-                            break
-                    if bad_client:
-                        continue
-                elif ext != ".ini":
+                bad_client = False
+                for i in CLIENT_PREFIXES:
+                    if fn.startswith(i):
+                        bad_client = (fn != launcher_exe)
+                        break
+                if bad_client:
                     continue
+            elif ext != ".ini":
+                continue
 
-                mfs.write(_do_file(item, "GameClient"))
+            lines.append(_queue_file(item, "GameClient"))
+        _write_manifest(name, lines)
 
     source = _args.source
     destination = _args.destination
@@ -359,65 +1129,384 @@ def _make_preloader_manifest():
     _process_dir(items, src, dst, "Python", "ClientPreload", {".pak"}, True)
     _process_dir(items, src, dst, "SDL", "ClientPreload", {".sdl"}, True)
 
-    abspath = os.path.join(dst, "SecurePreloader.mfs")
-    with open(abspath, "w") as mfs:
-        for i in items.values():
-            mfs.write(i)
+    _write_manifest("SecurePreloader.mfs", items.values())
 
 def _update_image_manifests():
     def barf_image(name, items, skip_exe_prefix):
-        with open(os.path.join(_args.destination, name), "w") as mfs:
-            for name, line in items.items():
-                fn, ext = os.path.splitext(name)
-                if ext.lower() in CLIENT_EXTENSIONS and fn.lower().startswith(skip_exe_prefix):
-                    continue
-                mfs.write(line)
+        lines = []
+        for item_name, line in items.items():
+            fn, ext = os.path.splitext(item_name)
+            if ext.lower() in CLIENT_EXTENSIONS and fn.lower().startswith(skip_exe_prefix):
+                continue
+            lines.append(line)
 
-    def load_items(fn, items):
-        with open(os.path.join(_args.destination, fn), "r") as mfs:
-            for line in mfs:
-                item_name = line.split(',', 1)[0]
-                items[item_name] = line
+        _write_text(os.path.join(_args.destination, name), (str(i) for i in lines))
+        _generated[name] = lines
 
-    # We can't assume this is a full build, so we need to test everything in our manifests
+    # We can't assume this is a full build, so we need to test everything in our manifests.
+    # Anything we generated this run is already in memory -- only the rest comes off the disk.
+    # The old image manifests go first so that anything fresher wins.
+    images = ("Internal.mfs", "External.mfs")
     items = {}
-    for mfs in os.listdir(_args.destination):
+    for mfs in sorted(os.listdir(_args.destination), key=lambda x: (x not in images, x)):
         if not mfs.endswith(".mfs"):
             continue
-        load_items(mfs, items)
+        lines = _generated.get(mfs)
+        if lines is None:
+            lines = _read_manifest(mfs)
+        for line in lines:
+            items[line.file.replace('\\', '/')] = line
     barf_image("Internal.mfs", items, "uru")
     barf_image("External.mfs", items, "pl")
 
 
 def make_manifests(files):
+    global _executor, _block_executor, _current_job
     if not os.path.isdir(_args.destination):
         os.makedirs(_args.destination)
 
-    while files:
-        mfs = files.pop()
-        if mfs.startswith("__"):
-            if mfs.startswith("__client"):
-                preloader = mfs.find("with_preloader") != -1
-                if preloader:
-                    print("Generating CLIENT manifests w/ preloader...")
-                else:
-                    print("Generating CLIENT manifests w/o preloader...")
-
-                _make_client_manifest(preloader)
-            elif mfs == "__auth_lists__":
-                print("Generating AUTH lists...")
-                _make_auth_lists()
-            elif mfs == "__file_preloader__":
-                print("Generating SECURE PRELOADER manifest...")
-                _make_preloader_manifest()
-        else:
-            print("Generating AGE manifest for '%s'..." % mfs)
-            _make_age_manifest(mfs)
+    # Kick off the age scans first -- we want those worker processes forked before any threads exist.
+    scans = {}
+    ages = [i for i in files if not i.startswith("__")]
+    if ages and _args.jobs > 1:
+        age_pool = ProcessPoolExecutor(max_workers=_args.jobs, initializer=_init_age_worker,
+                                       initargs=(_args, _index, _sound_cache))
+        for i in ages:
+            scans[i] = age_pool.submit(_scan_age_worker, i)
+    else:
+        age_pool = None
+    _executor = ThreadPoolExecutor(max_workers=max(_args.jobs, 1))
+    if _args.gzip_threads > 1:
+        _block_executor = ThreadPoolExecutor(max_workers=_args.gzip_threads)
+    _twins.clear()
+
+    try:
+        while files:
+            mfs = files.pop()
+            _current_job = mfs
+            if mfs.startswith("__"):
+                if mfs.startswith("__client"):
+                    preloader = mfs.find("with_preloader") != -1
+                    if preloader:
+                        print("Generating CLIENT manifests w/ preloader...")
+                    else:
+                        print("Generating CLIENT manifests w/o preloader...")
+
+                    with _Timer("client", thread_cpu=False):
+                        _make_client_manifest(preloader)
+                elif mfs == "__auth_lists__":
+                    print("Generating AUTH lists...")
+                    with _Timer("auth", thread_cpu=False):
+                        _make_auth_lists()
+                elif mfs == "__file_preloader__":
+                    print("Generating SECURE PRELOADER manifest...")
+                    with _Timer("preloader", thread_cpu=False):
+                        _make_preloader_manifest()
+            else:
+                print("Generating AGE manifest for '%s'..." % mfs)
+                with _Timer("age_manifest", thread_cpu=False):
+                    _make_age_manifest(mfs, scans.get(mfs))
+
+        # Everything is queued up, so now we can wait on it.
+        with _Timer("write", thread_cpu=False):
+            _write_pending()
+    except BaseException:
+        # Don't bother with anything that hasn't started yet.
+        del _pending[:]
+        for i in list(scans.values()) + list(_processed.values()):
+            i.cancel()
+        raise
+    finally:
+        _current_job = None
+
+        # Make sure nothing is still in flight (or left running if something blew up) before we
+        # start reading manifests back in
+        _executor.shutdown()
+        if _block_executor is not None:
+            _block_executor.shutdown()
+            _block_executor = None
+        if age_pool is not None:
+            age_pool.shutdown()
+
+        # Anything that didn't make it gets another shot next time (watch mode).
+        for file, future in list(_processed.items()):
+            if future.cancelled() or future.exception() is not None:
+                del _processed[file]
 
     # And finally... We always have to touch our(selves) image manifests
     print("Updating IMAGE manifests...")
-    _update_image_manifests()
+    with _Timer("image"):
+        _update_image_manifests()
+
+
+def _affected_jobs(changed, jobs, all_ages):
+    affected = set()
+    for i in changed:
+        affected.update(_dependents.get(i, ()))
+
+        # Brand new files won't be in the reverse index, so guess from where they are.
+        reldir = os.path.dirname(i) or "."
+        fn, ext = os.path.splitext(os.path.basename(i))
+        if reldir == "dat" and ext.lower() == ".age":
+            if all_ages and _index.isfile(i):
+                affected.add(os.path.basename(i))
+        elif reldir == "dat" and ext.lower() == ".prp":
+            agefile = "{}.age".format(fn.split("_District_", 1)[0])
+            if agefile in jobs:
+                affected.add(agefile)
+        elif reldir != "sfx":
+            affected.update(j for j in jobs if j.startswith("__"))
+    return affected
+
+def _watch(jobs, all_ages):
+    if INotify is not None:
+        inotify = INotify()
+        mask = (inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.MOVED_FROM |
+                inotify_flags.DELETE)
+        watches = {}
+        for i in SOURCE_DIRS:
+            path = os.path.join(_args.source, i)
+            if os.path.isdir(path):
+                watches[inotify.add_watch(path, mask)] = i
+    else:
+        print("    WARNING: inotify_simple is not installed, falling back to polling...")
+
+    print("Watching '%s' for changes..." % _args.source)
+    while True:
+        if INotify is not None:
+            # Content drops tend to come in bursts, so wait for things to settle down.
+            events = inotify.read()
+            while True:
+                more = inotify.read(timeout=1000)
+                if not more:
+                    break
+                events.extend(more)
+            reldirs = {watches[i.wd] for i in events if i.wd in watches}
+        else:
+            time.sleep(_args.watch_interval)
+            reldirs = set(SOURCE_DIRS)
 
+        changed = _index.rescan(reldirs)
+        if not changed:
+            continue
+        for i in changed:
+            _processed.pop(i, None)
+
+        affected = _affected_jobs(changed, jobs, all_ages)
+        for i in sorted(affected):
+            if i not in jobs:
+                jobs.append(i)
+
+        previous = _manifest_entries() if _args.delta else None
+
+        # Ages whose .age file went away just lose their manifest.
+        for i in [j for j in affected if not j.startswith("__") and not _index.isfile(os.path.join("dat", j))]:
+            print("Removing AGE manifest for '%s'..." % i)
+            mfs = "{}.mfs".format(os.path.splitext(i)[0])
+            mfs_path = os.path.join(_args.destination, mfs)
+            if os.path.isfile(mfs_path):
+                os.unlink(mfs_path)
+            _generated.pop(mfs, None)
+            jobs.remove(i)
+            affected.remove(i)
+
+        print("{} file(s) changed, regenerating {} manifest job(s)...".format(len(changed), len(affected)))
+        try:
+            # Keep the usual job order so the output matches a full build.
+            make_manifests([i for i in jobs if i in affected])
+        except Exception:
+            traceback.print_exc()
+            continue
+        if _args.cache:
+            _save_cache(_args.cache)
+        if _args.delta:
+            _write_delta(_args.delta, previous)
+
+def _decrypt_buffer(data):
+    buf = hsRAMStream()
+    buf.buffer = data
+    stream = plEncryptedStream()
+    stream.open(buf, fmRead, plEncryptedStream.kEncAuto)
+    if data[:12] == b"notthedroids":
+        stream.setKey(_droid_key)
+    data = stream.read(struct.unpack_from("<I", data, 12)[0])
+    stream.close()
+    return data
+
+def _gunzip_chunks(data):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in _iter_chunks(data):
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+    if not decompressor.eof:
+        raise zlib.error("truncated gzip stream")
+
+def _verify_base(line, data):
+    # Same deal as building: the base hash is of the file *before* it was encrypted, unless the
+    # source was already encrypted to begin with. Those are all small, so just do it in memory.
+    ext = _file_type(line.dest)
+    with _Timer("verify_base", ext) as timer:
+        chunks = _gunzip_chunks(data) if line.flag & ZIPPED else _iter_chunks(data)
+        if ext in XTEA_ENCRYPT or ext in DROID_ENCRYPT:
+            plain = b"".join(chunks)
+            if plain[:12] in ENCRYPTED_MAGIC and hashlib.md5(plain).hexdigest() != line.base_md5:
+                plain = _decrypt_buffer(plain)
+            chunks = (plain,)
+        md5, size = hashlib.md5(), 0
+        for chunk in chunks:
+            md5.update(chunk)
+            size += len(chunk)
+        timer.bytes_in = len(data)
+        timer.bytes_out = size
+    if md5.hexdigest() != line.base_md5 or size != line.base_size:
+        return "base {} bytes/{} (expected {} bytes/{})".format(size, md5.hexdigest(), line.base_size,
+                                                                line.base_md5)
+    return None
+
+def _verify_line(line, data, md5):
+    if line.flag & ZIPPED:
+        if len(data) != line.compress_size or md5 != line.compress_md5:
+            return "compressed {} bytes/{} (expected {} bytes/{})".format(len(data), md5, line.compress_size,
+                                                                          line.compress_md5)
+    elif len(data) >= 16 and bytes(data[:12]) in ENCRYPTED_MAGIC:
+        # Encrypted files aren't compressed, but at least the header tells us how big the source was.
+        size = struct.unpack_from("<I", data, 12)[0]
+        if size != line.base_size and len(data) != line.base_size:
+            return "encrypted {} bytes (expected {} bytes)".format(size, line.base_size)
+    elif len(data) != line.base_size or md5 != line.base_md5:
+        return "{} bytes/{} (expected {} bytes/{})".format(len(data), md5, line.base_size, line.base_md5)
+
+    if _args.verify_base:
+        try:
+            return _verify_base(line, data)
+        except zlib.error as e:
+            return "bad gzip stream ({})".format(e)
+    return None
+
+def _verify_file(dest, lines):
+    # Returns a list of problems with this FileSrv file. mmap lets the kernel page the file straight
+    # into hashlib and zlib, which drop the GIL, so the thread pool actually gets some work done.
+    path = os.path.join(_args.destination, dest)
+    try:
+        handle = open(path, "rb")
+    except FileNotFoundError:
+        return ["missing"]
+
+    with handle, _Timer("verify", _file_type(dest)) as timer:
+        size = os.fstat(handle.fileno()).st_size
+        data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        try:
+            md5 = hashlib.md5(data).hexdigest()
+            timer.bytes_in = size
+            problems = [i for i in (_verify_line(j, data, md5) for j in lines) if i is not None]
+            problems = list(collections.OrderedDict.fromkeys(problems))
+        finally:
+            if size:
+                data.close()
+    return problems
+
+def verify_filesrv():
+    # Returns the number of problems found
+    dests = collections.OrderedDict()
+    with _Timer("verify_parse"):
+        for name in sorted(os.listdir(_args.destination)):
+            if not name.lower().endswith(".mfs"):
+                continue
+            for line in _read_manifest(name):
+                line.dest = line.dest.replace('\\', '/')
+                lines = dests.setdefault(line.dest, {})
+                if line.flag & DELETED or _is_blacklisted(line.dest):
+                    continue
+                # The same file shows up in plenty of manifests, only check each version once.
+                lines.setdefault((line.base_md5, line.compress_md5, line.base_size,
+                                  line.compress_size, line.flag), line)
+
+    problems = []
+    with ThreadPoolExecutor(max_workers=max(_args.jobs, 1)) as executor:
+        futures = [(dest, executor.submit(_verify_file, dest, list(lines.values())))
+                   for dest, lines in dests.items() if lines]
+        for dest, future in futures:
+            # A mangled file is exactly what we're looking for, so don't let one stop the show.
+            try:
+                results = future.result()
+            except Exception as e:
+                results = ["error ({})".format(e)]
+            problems.extend("{}: {}".format(dest, i) for i in results)
+
+    # Anything lying around that no manifest knows about?
+    with _Timer("verify_orphans"):
+        for dirpath, dirnames, filenames in os.walk(_args.destination):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                relpath = os.path.relpath(os.path.join(dirpath, fn), _args.destination).replace(os.sep, '/')
+                if relpath.lower().endswith(".mfs") or relpath in dests:
+                    continue
+                problems.append("{}: orphaned".format(relpath))
+
+    for i in problems:
+        print(i)
+    print("Verified {} files, {} problems".format(sum(1 for i in dests.values() if i), len(problems)))
+    return len(problems)
+
+def _manifest_entries(path=None):
+    # What a FileSrv should contain according to its manifests: {relpath: (md5, manifest size, real size)},
+    # including the manifests themselves. Anything we generated this run comes straight out of memory.
+    # The manifest only knows the pre-encryption size of unzipped files, so the real size comes from
+    # the line if we built it, or the disk if we didn't.
+    entries = {}
+    path = path or _args.destination
+    if not os.path.isdir(path):
+        return entries
+    for name in sorted(os.listdir(path)):
+        if not name.lower().endswith(".mfs"):
+            continue
+        lines = _generated.get(name) if path == _args.destination else None
+        if lines is None:
+            lines = _read_manifest(name, path)
+        text = "".join(str(i) + "\n" for i in lines).encode("utf-8")
+        entries[name] = (hashlib.md5(text).hexdigest(), len(text), len(text))
+
+        for line in lines:
+            # Blacklisted and deleted files never hit the disk, so there's nothing to push.
+            if line.flag & DELETED or _is_blacklisted(line.dest):
+                continue
+            if line.flag & ZIPPED:
+                md5, size = line.compress_md5, line.compress_size
+            else:
+                md5, size = line.base_md5, line.base_size
+            real_size = line.dest_size
+            if real_size is None:
+                destpath = os.path.join(path, line.dest)
+                real_size = os.lstat(destpath).st_size if os.path.isfile(destpath) else size
+            entries[line.dest.replace('\\', '/')] = (md5, size, real_size)
+    return entries
+
+def _write_delta(fn, previous):
+    with _Timer("delta"):
+        current = _manifest_entries()
+        delta = {"added": [], "changed": [], "removed": []}
+        for relpath in sorted(set(previous) | set(current)):
+            old, new = previous.get(relpath), current.get(relpath)
+            if old is not None and new is not None and old[:2] == new[:2]:
+                continue
+            if old is None:
+                delta["added"].append({"file": relpath, "size": new[2]})
+            elif new is None:
+                delta["removed"].append({"file": relpath, "size": old[2]})
+            else:
+                delta["changed"].append({"file": relpath, "size": new[2]})
+        delta["transfer_size"] = sum(i["size"] for i in delta["added"] + delta["changed"])
+
+    with open(fn, "w") as handle:
+        json.dump(delta, handle, indent=2, sort_keys=True)
+    print("{} added, {} changed, {} removed ({} bytes to push)".format(len(delta["added"]), len(delta["changed"]),
+                                                                   len(delta["removed"]), delta["transfer_size"]))
+
+def _write_report(fn, wall, cpu):
+    # Machine readable, so the build dashboards can track us across content drops
+    report = {"wall": wall, "cpu": cpu, "jobs": _args.jobs, "phases": _stats.report()}
+    with open(fn, "w") as handle:
+        json.dump(report, handle, indent=2, sort_keys=True)
 
 def _make_droid_key():
     def buf_to_int(str):
@@ -433,19 +1522,23 @@ def _make_droid_key():
     _droid_key = (buf_to_int(key[0:8]), buf_to_int(key[8:16]),
                   buf_to_int(key[16:24]), buf_to_int(key[24:32]))
 
-def _find_dead_prps(source):
-    global _deadPRPs
-    for item in os.listdir(os.path.join(source, "dat")):
-        ext = os.path.splitext(item)[1].lower()
-        if ext != ".prp":
-            continue
-        abspath = os.path.join(source, "dat", item)
-        if os.lstat(abspath).st_size == 0:
-            _deadPRPs.add(os.path.join("dat", item))
-
 if __name__ == "__main__":
     _args = parser.parse_args()
+    _start_wall, _start_cpu = time.perf_counter(), time.process_time()
     _make_droid_key()
+    if _args.cache:
+        _load_cache(_args.cache)
+
+    # Now to abide by Cyan's "rules"
+    if _args.blacklist:
+        print("Loading Cyan content blacklist...")
+        _load_blacklist(_args.blacklist)
+
+    if _args.verify:
+        _problems = verify_filesrv()
+        if _args.report:
+            _write_report(_args.report, time.perf_counter() - _start_wall, time.process_time() - _start_cpu)
+        sys.exit(1 if _problems else 0)
 
     _use_defaults = (not _args.file_preloader and not _args.auth_preloader and not _args.client_manifests)
     _manifests = []
@@ -464,11 +1557,8 @@ if __name__ == "__main__":
         if _args.file_preloader:
             _manifests.append("__file_preloader__")
 
-    # Deleted PRP files generally do not appear in .age files, so we will be unable to deal with them
-    # the normal way. So, we need this hack here to check every single PRP to see if it's deleted...
-    # We won't worry about deleted oggs. Too much work to even think about predicting that!
-    if not _args.no_ages:
-        _find_dead_prps(_args.source)
+    with _Timer("walk"):
+        _index = _SourceIndex(_args.source)
 
     if _args.age:
         agefile = _args.age
@@ -477,13 +1567,20 @@ if __name__ == "__main__":
         _manifests.append(agefile)
     elif not _args.no_ages:
         # add all the ages to the list
-        agedir = os.path.join(_args.source, "dat")
-        for i in os.listdir(agedir):
-            if i.endswith(".age"):
-                _manifests.append(i)
-    make_manifests(_manifests)
+        for i in _index.by_ext("dat", ".age"):
+            _manifests.append(os.path.split(i)[1])
+    if _args.delta:
+        _previous = _manifest_entries(_args.previous)
+    make_manifests(list(_manifests))
 
-    # Now to abide by Cyan's "rules"
-    if _args.blacklist:
-        print("Blacklisting Cyan content...")
-        _blacklist(_args.blacklist)
+    if _args.cache:
+        _save_cache(_args.cache)
+
+    if _args.delta:
+        _write_delta(_args.delta, _previous)
+
+    if _args.report:
+        _write_report(_args.report, time.perf_counter() - _start_wall, time.process_time() - _start_cpu)
+
+    if _args.watch:
+        _watch(_manifests, not _args.age and not _args.no_ages)
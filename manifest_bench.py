@@ -0,0 +1,284 @@
+#    Manifest Generator Benchmark
+#    Copyright (C) 2014  Adam Johnson
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+import argparse
+from datetime import datetime
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description="Manifest Generator Benchmark",
+                                 epilog="""Generates a fake reference build, runs manifest.py on it and keeps the
+                                           results around so that build tool changes can be compared. Anything after
+                                           '--' is handed to manifest.py as-is.
+                                        """)
+parser.add_argument("--ages", help="Number of ages", type=int, default=20)
+parser.add_argument("--pages", help="Pages per age", type=int, default=5)
+parser.add_argument("--page-size", help="Average page size (KiB)", type=int, default=2048)
+parser.add_argument("--sounds", help="Sound buffers per page", type=int, default=4)
+parser.add_argument("--ogg-size", help="Average ogg size (KiB)", type=int, default=512)
+parser.add_argument("--dead-pages", help="Zero byte (dead) pages per age", type=int, default=1)
+parser.add_argument("--paks", help="Number of Python paks", type=int, default=2)
+parser.add_argument("--pak-size", help="Average pak size (KiB)", type=int, default=4096)
+parser.add_argument("--sdls", help="Number of SDL files", type=int, default=100)
+parser.add_argument("--seed", help="Random seed for the reference build", type=int, default=1)
+parser.add_argument("-l", "--label", help="Name for this set of results (eg a branch or commit)")
+parser.add_argument("-n", "--runs", help="Number of times to run manifest.py", type=int, default=3)
+parser.add_argument("-o", "--results", help="JSON file to store results in", default="manifest_bench.json")
+parser.add_argument("-w", "--workdir", help="Where to put the reference build and FileSrv (kept between runs)")
+parser.add_argument("--warm", help="Don't clear the FileSrv between runs (for -w, --cache, etc)",
+                    action="store_true")
+parser.add_argument("manifest_args", help="Arguments for manifest.py", nargs=argparse.REMAINDER)
+
+# Plasma bits
+PRP_VERSION = 6
+PAGE_VERSION = 70
+SOUND_BUFFER = 0x0029
+COMMON_PAGES = ("Textures", "BuiltIn")
+
+_args = None
+
+
+class _Filler:
+    # Making gigabytes of random data is slow, so we cut files out of a pool instead. Half of the
+    # pool is noise and half is (fairly) repetitive, so gzip has about as much work to do as on real
+    # PRPs. Same seed, same reference build.
+    def __init__(self, rnd, size=1024 * 1024 * 8):
+        noise = rnd.getrandbits(size * 4).to_bytes(size // 2, "little")
+        words = [rnd.getrandbits(64).to_bytes(8, "little") for i in range(64)]
+        text = b"".join(rnd.choice(words) for i in range(size // 16))
+        self._pool = noise + text
+        self._rnd = rnd
+
+    def get(self, size):
+        chunks = []
+        while size > 0:
+            length = min(size, self._rnd.randint(4096, 1024 * 1024))
+            offset = self._rnd.randint(0, len(self._pool) - length)
+            chunks.append(self._pool[offset:offset+length])
+            size -= length
+        return b"".join(chunks)
+
+    def size(self, kib):
+        # Something between half and one and a half times the average
+        return self._rnd.randint(kib * 512, kib * 1536)
+
+
+def _safe_string(value):
+    buf = value.encode("latin_1")
+    return struct.pack("<H", len(buf) | 0xF000) + bytes(~i & 0xFF for i in buf)
+
+def _location(seq_prefix, seq_suffix):
+    return struct.pack("<IH", (seq_prefix << 16) + seq_suffix + 33, 0)
+
+def _uoid(location, class_type, id, name):
+    return struct.pack("<B", 0) + location + struct.pack("<HI", class_type, id) + _safe_string(name)
+
+def _make_page(age, page, location, sounds, padding):
+    # Just enough of a PRP for plasmoul (and manifest.py) to be happy: a header, some plSoundBuffers,
+    # a pile of junk standing in for everything else, and the keyring.
+    header = struct.pack("<I", PRP_VERSION) + location + _safe_string(age) + _safe_string(page)
+    header += struct.pack("<HI", PAGE_VERSION, 0)
+    data_start = len(header) + 8
+
+    objects, keys = [], []
+    pos = data_start
+    for i, (fn, flags) in enumerate(sounds):
+        uoid = _uoid(location, SOUND_BUFFER, i + 1, "{}_{}".format(os.path.splitext(fn)[0], i))
+        obj = struct.pack("<HB", SOUND_BUFFER, 1) + uoid
+        obj += struct.pack("<II", flags, 0) + _safe_string(fn)
+        obj += struct.pack("<HHIIHH", 1, 1 if flags & 0x0C else 2, 44100, 176400, 4, 16)
+        keys.append(uoid + struct.pack("<II", pos, len(obj)))
+        objects.append(obj)
+        pos += len(obj)
+    objects.append(padding)
+    pos += len(padding)
+
+    keyring = struct.pack("<I", 1 if keys else 0)
+    if keys:
+        keylist = b"".join(keys)
+        keyring += struct.pack("<HIBI", SOUND_BUFFER, len(keylist) + 5, 0, len(keys)) + keylist
+    return header + struct.pack("<II", data_start, pos) + b"".join(objects) + keyring
+
+def _make_age_info(pages, seq_prefix):
+    info = ["StartDateTime=0000000000", "DayLength=24.000000", "MaxCapacity=10", "LingerTime=180",
+            "SequencePrefix={}".format(seq_prefix), "ReleaseVersion=0"]
+    info.extend("Page={},{},0".format(page, i) for i, page in enumerate(pages))
+    return ("\n".join(info) + "\n").encode("latin_1")
+
+def make_reference_build(path):
+    rnd = random.Random(_args.seed)
+    filler = _Filler(rnd)
+
+    def write(relpath, data):
+        with open(os.path.join(path, relpath), "wb") as handle:
+            handle.write(data)
+
+    for i in ("dat", "sfx", "Python", "SDL", "avi"):
+        os.makedirs(os.path.join(path, i), exist_ok=True)
+
+    # Some sounds show up in more than one age...
+    shared_oggs = ["Shared{:02}.ogg".format(i) for i in range(max(_args.sounds, 1))]
+    for i in shared_oggs:
+        write(os.path.join("sfx", i), b"OggS" + filler.get(filler.size(_args.ogg_size)))
+
+    for i in range(_args.ages):
+        age = "BenchAge{:03}".format(i)
+        seq_prefix = 100 + i
+        pages = ["Page{:02}".format(j) for j in range(_args.pages)]
+        write(os.path.join("dat", "{}.age".format(age)), _make_age_info(pages, seq_prefix))
+        write(os.path.join("dat", "{}.fni".format(age)), b"Graphics.Renderer.SetClearColor 0 0 0\n")
+        write(os.path.join("dat", "{}.csv".format(age)), b"Layer,Material\n" * 10)
+
+        for j, page in enumerate(list(COMMON_PAGES) + pages):
+            sounds = []
+            if page not in COMMON_PAGES:
+                for k in range(_args.sounds):
+                    if k % 2:
+                        fn = rnd.choice(shared_oggs)
+                    else:
+                        fn = "{}_{}_{:02}.ogg".format(age, page, k)
+                        write(os.path.join("sfx", fn), b"OggS" + filler.get(filler.size(_args.ogg_size)))
+                    flags = rnd.choice((0x01, 0x01 | 0x04, 0x01 | 0x10))
+                    sounds.append((fn, flags))
+            prp = _make_page(age, page, _location(seq_prefix, j), sounds, filler.get(filler.size(_args.page_size)))
+            write(os.path.join("dat", "{}_District_{}.prp".format(age, page)), prp)
+
+        for j in range(_args.dead_pages):
+            write(os.path.join("dat", "{}_District_Dead{:02}.prp".format(age, j)), b"")
+
+    for i in range(_args.paks):
+        write(os.path.join("Python", "bench{:02}.pak".format(i)), filler.get(filler.size(_args.pak_size)))
+    for i in range(_args.sdls):
+        sdl = "STATEDESC bench{0:03}\n{{\n    VERSION 1\n    VAR BOOL bench{0:03}Vis[1] DEFAULT=1\n}}\n".format(i)
+        write(os.path.join("SDL", "bench{:03}.sdl".format(i)), sdl.encode("latin_1"))
+
+    write(os.path.join("dat", "English.loc"), filler.get(256 * 1024))
+    write(os.path.join("avi", "intro.webm"), filler.get(filler.size(8192)))
+    write("plClient.exe", filler.get(filler.size(4096)))
+    write("UruLauncher.exe", filler.get(filler.size(1024)))
+    write("urustart.ini", b"[Client]\n")
+
+def _config():
+    # Everything that has to match for two results to be comparable
+    config = {i: getattr(_args, i) for i in ("ages", "pages", "page_size", "sounds", "ogg_size", "dead_pages",
+                                            "paks", "pak_size", "sdls", "seed", "warm")}
+    config["manifest_args"] = _manifest_args()
+    return config
+
+def _manifest_args():
+    args = list(_args.manifest_args)
+    if args and args[0] == "--":
+        args = args[1:]
+    return args
+
+def run_manifest(source, destination, report):
+    manifest = os.path.join(os.path.dirname(os.path.abspath(__file__)), "manifest.py")
+    cmd = [sys.executable, manifest, "-s", source, "-d", destination, "-r", report] + _manifest_args()
+    start = time.perf_counter()
+    subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+    wall = time.perf_counter() - start
+
+    with open(report, "r") as handle:
+        result = json.load(handle)
+    result["total_wall"] = wall
+    return result
+
+def _phase_walls(result):
+    return {phase: totals["wall"] for phase, totals in result["phases"].items()}
+
+def _best(runs):
+    # The fastest run is the one least disturbed by whatever else the machine was up to
+    best = {"total_wall": min(i["total_wall"] for i in runs)}
+    for run in runs:
+        for phase, wall in _phase_walls(run).items():
+            best[phase] = min(best.get(phase, wall), wall)
+    return best
+
+def print_comparison(old, new):
+    old_best, new_best = _best(old["runs"]), _best(new["runs"])
+    print("Compared to '{}' ({}):".format(old.get("label") or "unlabeled", old["date"]))
+    print("    {:<20} {:>10} {:>10} {:>8}".format("phase", "before", "after", "change"))
+    for phase in ["total_wall"] + sorted((set(old_best) | set(new_best)) - {"total_wall"}):
+        before, after = old_best.get(phase), new_best.get(phase)
+        if before and after is not None:
+            change = "{:+.1f}%".format((after - before) / before * 100.0)
+        else:
+            change = "-"
+        print("    {:<20} {:>10} {:>10} {:>8}".format(phase, "-" if before is None else "{:.3f}".format(before),
+                                                  "-" if after is None else "{:.3f}".format(after), change))
+
+
+if __name__ == "__main__":
+    _args = parser.parse_args()
+
+    workdir = _args.workdir or tempfile.mkdtemp(prefix="manifest_bench")
+    source = os.path.join(workdir, "reference_build")
+    destination = os.path.join(workdir, "FileSrv")
+    report = os.path.join(workdir, "report.json")
+
+    # Regenerate the reference build whenever the config changes, otherwise reuse it.
+    stamp = os.path.join(workdir, "reference_build.json")
+    config = _config()
+    build_config = {k: v for k, v in config.items() if k not in {"manifest_args", "warm"}}
+    try:
+        with open(stamp, "r") as handle:
+            up_to_date = json.load(handle) == build_config
+    except (IOError, ValueError):
+        up_to_date = False
+    if not up_to_date:
+        print("Generating reference build in '{}'...".format(source))
+        if os.path.isdir(source):
+            shutil.rmtree(source)
+        make_reference_build(source)
+        with open(stamp, "w") as handle:
+            json.dump(build_config, handle)
+
+    runs = []
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    for i in range(_args.runs):
+        if not _args.warm and os.path.isdir(destination):
+            shutil.rmtree(destination)
+        print("Run {}/{}...".format(i + 1, _args.runs), end="")
+        sys.stdout.flush()
+        runs.append(run_manifest(source, destination, report))
+        print(" {:.3f}s".format(runs[-1]["total_wall"]))
+
+    result = {"date": datetime.now().isoformat(), "label": _args.label, "config": config, "runs": runs}
+    try:
+        with open(_args.results, "r") as handle:
+            results = json.load(handle)
+    except (IOError, ValueError):
+        results = []
+
+    previous = [i for i in results if i["config"] == config]
+    if previous:
+        print_comparison(previous[-1], result)
+
+    results.append(result)
+    with open(_args.results, "w") as handle:
+        json.dump(results, handle, indent=2, sort_keys=True)
+
+    if not _args.workdir:
+        shutil.rmtree(workdir)
@@ -15,89 +15,172 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function
+import mmap
 import struct
 import sys
 
 if sys.version_info[0] > 2:
+    from sys import intern
     xrange = range
 
+# for un-obfuscating safe strings
+_INVERT = bytes(bytearray(~i & 0xFF for i in xrange(256)))
 
-class uoid:
-    location = (0, 0)
-    class_type = 0x8000
-    name = None
+# objects closer together than this get read in one go by page.get_objects
+_RUN_GAP = 64 * 1024
+
+
+def _pack_location(location):
+    prefix, suffix = location
+    if prefix < 0:
+        return ((-prefix) << 16) + suffix + 0xFF000001
+    return (prefix << 16) + suffix + 33
+
+def _unpack_location(num):
+    if num & 0x80000000:
+        num -= 0xFF000001
+        prefix = num >> 16
+        suffix = num - (prefix << 16)
+        prefix *= -1
+    else:
+        num -= 33
+        prefix = num >> 16
+        suffix = num - (prefix << 16)
+    return (prefix, suffix)
+
+
+class uoid(object):
+    # There are a *lot* of these, so keep them tiny. The location stays as the sequence number
+    # it was stored as, and names are interned (every page refers to the same objects over and over).
+    __slots__ = ("_location", "class_type", "name")
+
+    def __init__(self, location=(0, 0), class_type=0x8000, name=None):
+        self._location = _pack_location(location)
+        self.class_type = class_type
+        self.name = name
 
     def __eq__(self, rhs):
-        if self.location == rhs.location:
+        if not isinstance(rhs, uoid):
+            return NotImplemented
+        if self._location == rhs._location:
             if self.class_type == rhs.class_type:
                 if self.name == rhs.name:
                     return True
         return False
 
+    def __ne__(self, rhs):
+        result = self.__eq__(rhs)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash((self._location, self.class_type, self.name))
+
+    @property
+    def location(self):
+        return _unpack_location(self._location)
+
+    @location.setter
+    def location(self, value):
+        self._location = _pack_location(value)
+
     def read(self, s):
         contents = s.readu8()
-        self.location = s.read_location()
+        self._location = s.read_sequence()
 
         # load mask
         if contents & 0x02:
-            s.readu8()
+            s.skip(1)
 
         self.class_type = s.readu16()
-        s.readu32() # object ID -- we don't give a rat's
-        self.name = s.read_safe_string()
+        s.skip(4) # object ID -- we don't give a rat's
+        self.name = intern(s.read_safe_string())
 
         # clone IDs
         if contents & 0x01:
-            s.readu16() # clone ID
-            s.readu16() # garbage
-            s.readu32() # clone player ID
+            s.skip(2) # clone ID
+            s.skip(2) # garbage
+            s.skip(4) # clone player ID
 
 
 class _stream:
+    # Everything comes out of one big buffer (mapped, if we can manage it) instead of going back
+    # to the file for every little field -- keyrings are nothing but little fields.
+    _u8 = struct.Struct("<B")
+    _u16 = struct.Struct("<H")
+    _u32 = struct.Struct("<I")
+    _location = struct.Struct("<IH")
+
     def __init__(self, file):
         self._file = file
+        try:
+            self._buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            # empty files can't be mapped, and neither can some other weird stuff
+            self._buf = file.read()
+        self._pos = 0
 
     def close(self):
-        self._file.close()
+        try:
+            if isinstance(self._buf, mmap.mmap):
+                self._buf.close()
+        finally:
+            self._file.close()
+
+    def read(self, size):
+        if self._pos + size > len(self._buf):
+            raise EOFError("read past end of page")
+        value = self._buf[self._pos:self._pos+size]
+        self._pos += size
+        return value
 
     def read_location(self):
-        #self._file.read(6) # seqnum (32) + flags (16)
-        num = self.readu32()
-        flags = self.readu16()
-
-        if num & 0x80000000:
-            num -= 0xFF000001
-            prefix = num >> 16
-            suffix = num - (prefix << 16)
-            prefix *= -1
-        else:
-            num -= 33
-            prefix = num >> 16
-            suffix = num - (prefix << 16)
-        return (prefix, suffix)
+        return _unpack_location(self.read_sequence())
+
+    def read_sequence(self):
+        # location as the raw sequence number (flags are useless to us)
+        num, flags = self._location.unpack_from(self._buf, self._pos)
+        self._pos += 6
+        return num
 
     def read_safe_string(self):
         _chars = self.readu16()
         if (_chars & 0xF000) == 0:
-            self._file.read(2) # old style 32-bit count
+            self._pos += 2 # old style 32-bit count
         _chars &= ~0xF000
         if not _chars:
             return ""
 
-        _buf = bytearray(self._file.read(_chars))
-        if _buf[0] & 0x80:
-            for i in xrange(_chars):
-                _buf[i] = ~_buf[i] & 0xFF
+        _buf = self._buf[self._pos:self._pos+_chars]
+        if len(_buf) != _chars:
+            raise EOFError("read past end of page")
+        self._pos += _chars
+        if ord(_buf[:1]) & 0x80:
+            _buf = _buf.translate(_INVERT)
         return _buf.decode("latin_1")
 
     def readu8(self):
-        return int(struct.unpack("<B", self._file.read(1))[0])
+        value = self._u8.unpack_from(self._buf, self._pos)[0]
+        self._pos += 1
+        return value
 
     def readu16(self):
-        return int(struct.unpack("<H", self._file.read(2))[0])
+        value = self._u16.unpack_from(self._buf, self._pos)[0]
+        self._pos += 2
+        return value
 
     def readu32(self):
-        return int(struct.unpack("<I", self._file.read(4))[0])
+        value = self._u32.unpack_from(self._buf, self._pos)[0]
+        self._pos += 4
+        return value
+
+    def read_string(self, size):
+        if self._pos + size > len(self._buf):
+            raise EOFError("read past end of page")
+        value = self._buf[self._pos:self._pos+size].decode("latin_1")
+        self._pos += size
+        return value
 
     def read_uoid(self):
         if self.readu8():
@@ -107,13 +190,45 @@ class _stream:
         return None
 
     def set_position(self, pos):
-        self._file.seek(pos, 0)
+        self._pos = pos
+
+    def skip(self, size):
+        self._pos += size
 
+    def tell(self):
+        return self._pos
 
-class key(uoid):
-    uoid = None
-    pos = None
-    length = -1
+    def prefetch(self, pos, size):
+        # Ask the kernel to pull in a whole range at once, rather than faulting it in a page at a time
+        if not isinstance(self._buf, mmap.mmap) or not hasattr(self._buf, "madvise"):
+            return
+        start = pos - (pos % mmap.PAGESIZE)
+        size = min(pos + size, len(self._buf)) - start
+        if size > 0:
+            self._buf.madvise(mmap.MADV_WILLNEED, start, size)
+
+
+class key(object):
+    __slots__ = ("uoid", "pos", "length")
+
+    def __init__(self):
+        self.uoid = None
+        self.pos = None
+        self.length = -1
+
+    def __eq__(self, rhs):
+        if not isinstance(rhs, key):
+            return NotImplemented
+        return self.uoid == rhs.uoid
+
+    def __ne__(self, rhs):
+        result = self.__eq__(rhs)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self.uoid)
 
     def read(self, s):
         self.uoid = uoid()
@@ -130,6 +245,124 @@ class hsKeyedObject:
         assert self.uoid
 
 
+class plSynchedObject(hsKeyedObject):
+    class_type = 0x0028
+
+    EXCLUDE_PERSISTENT_STATE = 0x10
+    HAS_VOLATILE_STATE = 0x40
+
+    def read(self, s):
+        hsKeyedObject.read(self, s)
+
+        self.synch_flags = s.readu32()
+        self.sdl_exclude = []
+        if self.synch_flags & plSynchedObject.EXCLUDE_PERSISTENT_STATE:
+            self.sdl_exclude = [s.read_string(s.readu16()) for i in xrange(s.readu16())]
+        self.sdl_volatile = []
+        if self.synch_flags & plSynchedObject.HAS_VOLATILE_STATE:
+            self.sdl_volatile = [s.read_string(s.readu16()) for i in xrange(s.readu16())]
+
+
+class plSingleModifier(plSynchedObject):
+    class_type = 0x003D
+
+    def read(self, s):
+        plSynchedObject.read(self, s)
+
+        # hsBitVector -- nobody cares
+        s.skip(s.readu32() * 4)
+
+
+class plBitmap(hsKeyedObject):
+    class_type = 0x0003
+
+    UNCOMPRESSED = 0
+    DIRECTX_COMPRESSION = 1
+    JPEG_COMPRESSION = 2
+    PNG_COMPRESSION = 3
+
+    def read(self, s):
+        hsKeyedObject.read(self, s)
+
+        s.skip(1) # version
+        self.pixel_size = s.readu8()
+        self.space = s.readu8()
+        self.flags = s.readu16()
+        self.compression_type = s.readu8()
+        if self.compression_type == plBitmap.DIRECTX_COMPRESSION:
+            self.block_size = s.readu8()
+            self.dxt_type = s.readu8()
+            self.uncompressed_type = None
+        else:
+            self.block_size = None
+            self.dxt_type = None
+            self.uncompressed_type = s.readu8()
+        self.low_mod_time = s.readu32()
+        self.high_mod_time = s.readu32()
+
+
+class plMipmap(plBitmap):
+    class_type = 0x0004
+
+    def read(self, s):
+        # Header only -- the pixels are left right where they are.
+        plBitmap.read(self, s)
+
+        self.width = s.readu32()
+        self.height = s.readu32()
+        self.stride = s.readu32()
+        self.total_size = s.readu32()
+        self.num_levels = s.readu8()
+
+
+class plSceneObject(plSynchedObject):
+    class_type = 0x0001
+
+    def read(self, s):
+        # Just the interfaces, no modifiers or scene node
+        plSynchedObject.read(self, s)
+
+        self.draw_interface = s.read_uoid()
+        self.sim_interface = s.read_uoid()
+        self.coord_interface = s.read_uoid()
+        self.audio_interface = s.read_uoid()
+        self.interfaces = [s.read_uoid() for i in xrange(s.readu32())]
+
+
+class plImageLibMod(plSingleModifier):
+    class_type = 0x0122
+
+    def read(self, s):
+        plSingleModifier.read(self, s)
+
+        self.images = [s.read_uoid() for i in xrange(s.readu32())]
+
+
+class plClothingItem(hsKeyedObject):
+    class_type = 0x00BB
+
+    def read(self, s):
+        # Stops after the textures, so no meshes, accessories, or default tints
+        hsKeyedObject.read(self, s)
+
+        self.item_name = s.read_safe_string()
+        self.group = s.readu8()
+        self.type = s.readu8()
+        self.tileset = s.readu8()
+        self.sort_order = s.readu8()
+        self.description = s.read_safe_string()
+        self.custom_text = s.read_safe_string()
+        self.icon = s.read_uoid() if s.readu8() else None
+
+        # (element name, layer, texture key)
+        self.textures = []
+        for i in xrange(s.readu32()):
+            element = s.read_safe_string()
+            for j in xrange(s.readu8()):
+                layer = s.readu8()
+                self.textures.append((element, layer, s.read_uoid()))
+
+
 class plSoundBuffer(hsKeyedObject):
     class_type = 0x0029
 
@@ -172,7 +405,7 @@ class plSoundBuffer(hsKeyedObject):
 
 
 # all plasma classes -- leave out ABCs to save time.
-_pClasses = (plSoundBuffer,)
+_pClasses = (plSoundBuffer, plMipmap, plSceneObject, plImageLibMod, plClothingItem, plBitmap)
 
 
 class page:
@@ -206,25 +439,38 @@ class page:
         s = self._stream # lazy
         s.set_position(self._index_pos)
 
+        # Most people only care about one or two types, so just remember where each type's keys
+        # are for now. They get read the first time someone asks for them.
         self._keyring = {}
+        self._key_lists = {}
 
         types = s.readu32()
         for i in xrange(types):
             pClass = s.readu16()
-            s.readu32() # key list length (in bytes) -- garbage
-            s.readu8() # nonsense
-            numKeys = s.readu32()
+            length = s.readu32() # key list length (in bytes)
+            self._key_lists[pClass] = s.tell()
+            s.skip(length)
 
-            self._keyring[pClass] = [None] * numKeys
-            for j in xrange(numKeys):
-                self._keyring[pClass][j] = key()
-                self._keyring[pClass][j].read(s)
+    def _read_keys(self, pClass):
+        s = self._stream # lazy
+        s.set_position(self._key_lists[pClass])
+        s.skip(1) # nonsense
+        numKeys = s.readu32()
+
+        keys = [None] * numKeys
+        for i in xrange(numKeys):
+            keys[i] = key()
+            keys[i].read(s)
+        return keys
 
     def get_keys(self, pClass):
-        try:
-            return tuple(self._keyring[pClass])
-        except LookupError:
-            return tuple()
+        keys = self._keyring.get(pClass)
+        if keys is None:
+            if pClass not in self._key_lists:
+                return tuple()
+            keys = self._read_keys(pClass)
+            self._keyring[pClass] = keys
+        return tuple(keys)
 
     def get_object(self, key):
         s = self._stream
@@ -245,6 +491,24 @@ class page:
         obj.read(s)
         return obj
 
+    def get_objects(self, keys):
+        # Objects come out in the order they are in the file, NOT the order they were asked for.
+        # Each run of (nearly) back-to-back objects is read in one go, so big pages get one pass.
+        keys = sorted(keys, key=lambda x: x.pos)
+        i = 0
+        while i < len(keys):
+            start = keys[i].pos
+            end = start + max(keys[i].length, 0)
+            j = i + 1
+            while j < len(keys) and keys[j].pos - end < _RUN_GAP:
+                end = max(end, keys[j].pos + max(keys[j].length, 0))
+                j += 1
+
+            self._stream.prefetch(start, end - start)
+            for k in keys[i:j]:
+                yield self.get_object(k)
+            i = j
+
 # Test code
 if __name__ == "__main__":
     with page("GuildPub-Writers_District_Pub.prp") as prp: